@@ -1,14 +1,31 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import requests
+import logging
+import os
+import threading
 import time
-import random
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson is an optional, faster JSON decoder; fall back to requests' own decoding without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # --- Constants & Configuration ---
-# Use st.secrets to securely access the API key
-COINGECKO_API_KEY = st.secrets["COINGECKO_API_KEY"]
+logger = logging.getLogger(__name__)
 COINGECKO_BASE_URL = "https://api.coingecko.com/api/v3"
-HEADERS = {"x-cg-demo-api-key": COINGECKO_API_KEY}
+# Days of history to request. CoinGecko returns hourly points for ranges up to 90 days and
+# daily points beyond that, so 91 keeps the payload to one point per day.
+HISTORY_DAYS = 91
+# Records the UTC date the persisted fetch cache was last pruned for. Kept alongside Streamlit's
+# own on-disk cache so that pruning also works across restarts.
+FETCH_CACHE_DATE_FILE = os.path.join(os.path.expanduser("~"), ".streamlit", "fetch_cache_date")
 
 # Corrected Top 10 coins by CoinGecko ranking as of late 2025.
 TOP_10_COINS = [
@@ -24,69 +41,210 @@ TOP_10_COINS = [
     'chainlink'
 ]
 
-# --- Helper Function with Exponential Backoff ---
-def fetch_data_with_backoff(url, headers, max_retries=5, backoff_factor=1):
-    """
-    Fetches data from a URL with exponential backoff and jitter for rate-limiting.
-    """
-    retries = 0
-    while retries < max_retries:
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            if response.status_code == 429:
-                delay = (backoff_factor * (2 ** retries)) + random.uniform(0, 1)
-                st.warning(f"Rate limit hit. Retrying in {delay:.2f} seconds... (Attempt {retries + 1}/{max_retries})")
-                time.sleep(delay)
-                retries += 1
-            else:
-                st.error(f"Error fetching data from {url}: {e}")
-                return None
-    st.error("Max retries exceeded. Could not fetch data.")
-    return None
+# Shared HTTP session: pooled keep-alive connections, with urllib3 handling
+# exponential backoff on rate limits (429) and transient server errors.
+# Built once per server process rather than on every script rerun.
+@st.cache_resource
+def _session():
+    s = requests.Session()
+    # Use st.secrets to securely access the API key
+    s.headers.update({"x-cg-demo-api-key": st.secrets["COINGECKO_API_KEY"]})
+    s.mount("https://", HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=1,
+            status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=True,
+            allowed_methods=["GET"]
+        )
+    ))
+    return s
+
+class TokenBucket:
+    """Thread-safe token bucket allowing bursts of up to `capacity` calls, refilled at `rate` calls per second."""
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes one token, sleeping only as long as needed to stay within the rate."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+# CoinGecko's demo plan allows 30 calls per minute. A full burst plus a minute of refill
+# (capacity + 60 * rate) must stay within that, while one burst still covers a cold load of
+# all ten coins. Shared across reruns and sessions. Retries made by the session's urllib3
+# adapter happen below this limiter and don't take tokens.
+@st.cache_resource
+def _rate_limiter():
+    return TokenBucket(capacity=10, rate=20 / 60)
 
 # --- Data Fetching Functions ---
-@st.cache_data(ttl=3600)
-def fetch_coin_market_data(coin_id):
-    """Fetches historical market cap for a specific coin."""
-    url = f"{COINGECKO_BASE_URL}/coins/{coin_id}/market_chart?vs_currency=usd&days=90"
-    data = fetch_data_with_backoff(url, HEADERS)
-    if data:
-        df = pd.DataFrame(data['market_caps'], columns=['timestamp', 'market_cap'])
-        df['timestamp'] = pd.to_datetime(df['timestamp'], unit='ms').dt.date
-        df.drop_duplicates(subset=['timestamp'], keep='last', inplace=True)
-        df.set_index('timestamp', inplace=True)
-        return df['market_cap'].rename(coin_id)
-    return None
-
-@st.cache_data(ttl=3600)
-def fetch_aggregated_total_market_cap():
-    """
-    Aggregates market cap from individual top coins to approximate total market cap.
-    """
+# History is requested over a fixed range ending at UTC midnight, so it only changes once per
+# UTC day; results are persisted to disk and keyed on that date rather than refreshed hourly.
+# No ttl: Streamlit ignores it for persisted functions, and date_key already rotates daily.
+# max_entries only bounds the in-memory layer; old days' pickles on disk are pruned by
+# _prune_stale_fetch_cache.
+@st.cache_data(persist="disk", max_entries=64, show_spinner=False)
+def fetch_coin_market_data(coin_id, date_key):
+    """Fetches historical market cap for a specific coin. date_key rotates the cache once per UTC day."""
+    to_ts = int(datetime.fromisoformat(date_key).replace(tzinfo=timezone.utc).timestamp())
+    from_ts = to_ts - HISTORY_DAYS * 86_400
+    url = f"{COINGECKO_BASE_URL}/coins/{coin_id}/market_chart/range?vs_currency=usd&from={from_ts}&to={to_ts}"
+    _rate_limiter().acquire()
+    logger.debug("fetch %s", url)
+    # Failures raise rather than return None: st.cache_data doesn't cache exceptions, so a
+    # failed coin is retried on the next run while the ones that succeeded stay cached.
+    r = _session().get(url, timeout=10)
+    # 429/5xx were already retried by the session, so any other non-2xx status is final
+    if not r.ok:
+        raise requests.exceptions.HTTPError(f"HTTP {r.status_code} from {url}", response=r)
+    try:
+        data = orjson.loads(r.content) if orjson else r.json()
+    except ValueError as e:
+        raise ValueError(f"Invalid JSON from {url}: {e}") from e
+    # An empty or error body (e.g. {"error": ...}) must raise too, or it would be cached for the day
+    market_caps = data.get('market_caps') if isinstance(data, dict) else None
+    if not market_caps:
+        raise ValueError(f"No market_caps in response from {url}")
+    raw = np.asarray(market_caps, dtype=np.float64).reshape(-1, 2)
+    # Floor ms epochs to whole days as datetime64 rather than boxing them into Python date objects
+    days = (raw[:, 0].astype(np.int64) // 86_400_000).astype('datetime64[D]')
+    series = pd.Series(raw[:, 1].astype(np.float32), index=pd.Index(days, name='timestamp'), name=coin_id)
+    return series[~series.index.duplicated(keep='last')]
+
+def fetch_all_coin_data(date_key):
+    """Fetches the top coins in parallel, returning a dict of coin id to market cap series for those that succeeded."""
+    with ThreadPoolExecutor(max_workers=10) as ex:
+        futures = {coin_id: ex.submit(fetch_coin_market_data, coin_id, date_key) for coin_id in TOP_10_COINS}
+
     all_coin_market_caps = {}
-    for coin_id in TOP_10_COINS:
-        market_cap_series = fetch_coin_market_data(coin_id)
-        if market_cap_series is not None and not market_cap_series.empty:
-            all_coin_market_caps[coin_id] = market_cap_series
-        time.sleep(0.5)
+    for coin_id, future in futures.items():
+        try:
+            all_coin_market_caps[coin_id] = future.result()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # Fetches run on worker threads, so failures are logged rather than emitted as Streamlit elements
+            logger.warning("Error fetching market data for %s: %s", coin_id, e)
+    return all_coin_market_caps
 
-    if not all_coin_market_caps:
+# Streamlit never evicts persisted entries from disk, so the fetch cache is cleared whenever
+# the UTC date moves past the one recorded in FETCH_CACHE_DATE_FILE. The marker is read back on
+# startup, so a restart on a later day prunes too, while a mid-day restart keeps today's entries.
+@st.cache_resource
+def _fetch_cache_date():
+    try:
+        with open(FETCH_CACHE_DATE_FILE) as f:
+            date_key = f.read().strip() or None
+    except OSError:
+        date_key = None
+    return {'date_key': date_key, 'lock': threading.Lock()}
+
+def _prune_stale_fetch_cache(date_key):
+    """Drops previous days' fetch cache entries, in memory and on disk, once the UTC date moves forward."""
+    cache_date = _fetch_cache_date()
+    with cache_date['lock']:
+        # ISO dates sort chronologically. Only a newer date clears, so a session still holding
+        # yesterday's key around midnight can't wipe today's fresh entries.
+        if cache_date['date_key'] is not None and date_key <= cache_date['date_key']:
+            return
+        fetch_coin_market_data.clear()
+        cache_date['date_key'] = date_key
+        try:
+            os.makedirs(os.path.dirname(FETCH_CACHE_DATE_FILE), exist_ok=True)
+            with open(FETCH_CACHE_DATE_FILE, "w") as f:
+                f.write(date_key)
+        except OSError as e:
+            logger.warning("Could not record fetch cache date in %s: %s", FETCH_CACHE_DATE_FILE, e)
+
+# --- Indicator Helpers ---
+def last_sma(a, w):
+    """Returns only the latest value of the w-period simple moving average (NaN if there is too little data)."""
+    if len(a) < w:
+        return np.nan
+    return a[-w:].mean()
+
+def indicator(a, w_short=10, w_long=30):
+    """Returns the latest short- and long-window SMA values of an indicator series."""
+    a = np.asarray(a, dtype=np.float64)
+    return last_sma(a, w_short), last_sma(a, w_long)
+
+# Determine trend and create a formatted string for display
+def get_trend_string(sma10, sma30):
+    if sma10 > sma30:
+        return "🟢 **<span style='color:green'>Bullish</span>**"
+    else:
+        return "🔴 **<span style='color:red'>Bearish</span>**"
+
+# --- Indicator Pipeline ---
+@st.cache_data(ttl=24*3600, show_spinner=False)
+def build_indicators(date_key):
+    """
+    Turns the raw fetches into the arrays behind the dashboard, so reruns skip all of the assembly work.
+    Returns a dict of aligned float64 arrays keyed by column name, or None if there isn't enough data.
+    """
+    individual_coin_market_caps = fetch_all_coin_data(date_key)
+    if not individual_coin_market_caps:
         st.error("Could not fetch market data for any of the top coins.")
         return None
 
-    combined_df = pd.DataFrame(all_coin_market_caps)
-    combined_df = combined_df.dropna()
-
-    if combined_df.empty:
-        st.error("Combined market cap data is empty after dropping NaNs.")
+    # Align every coin on the dates they all share, then stack them into one matrix with a
+    # contiguous row per coin so the rest of the pipeline indexes by position, not label.
+    coin_ids = [coin for coin in TOP_10_COINS if coin in individual_coin_market_caps]
+    idx = individual_coin_market_caps[coin_ids[0]].index
+    for coin_id in coin_ids[1:]:
+        idx = idx.intersection(individual_coin_market_caps[coin_id].index)
+    mat = np.empty((len(coin_ids), len(idx)), dtype=np.float64)
+    for i, coin_id in enumerate(coin_ids):
+        mat[i] = individual_coin_market_caps[coin_id].reindex(idx).to_numpy()
+    # One validity mask over the inputs that matter, applied in a single slice
+    valid = np.isfinite(mat).all(axis=0)
+    mat = mat[:, valid]
+    if mat.shape[1] == 0:
+        st.error("Combined market cap data is empty after dropping invalid values.")
         return None
 
-    total_market_cap_series = combined_df.sum(axis=1) * 1.10
-    total_market_cap_series.name = 'TOTAL'
-    return total_market_cap_series
+    cols = {coin_id: mat[i] for i, coin_id in enumerate(coin_ids)}
+    cols['SUM_TOP_10'] = mat.sum(axis=0)
+    # Approximate the total market cap as the top coins plus a 10% buffer for the rest of the market.
+    # The top-10 sum is computed once and reused for both TOTAL and OTHERS.
+    cols['TOTAL'] = cols['SUM_TOP_10'] * 1.10
+
+    if 'bitcoin' in cols:
+        cols['TOTAL2'] = cols['TOTAL'] - cols['bitcoin']
+        cols['OTHERS'] = cols['TOTAL'] - cols['SUM_TOP_10']
+        # Scale the ratios in place rather than allocating a temporary for each step
+        cols['TOTAL2_DIV_TOTAL'] = np.divide(cols['TOTAL2'], cols['TOTAL'])
+        cols['TOTAL2_DIV_TOTAL'] *= 100
+        cols['OTHERS_DIV_TOTAL'] = np.divide(cols['OTHERS'], cols['TOTAL'])
+        cols['OTHERS_DIV_TOTAL'] *= 100
+    return cols
+
+# --- Indicator Panels ---
+# Each panel is a fragment so that an interaction inside one only reruns that panel,
+# not the whole script.
+@st.fragment
+def indicator_panel(title, description, values):
+    """Renders one indicator row: its title and description next to the current trend."""
+    # Use st.columns for a clean, table-like layout
+    col1, col2 = st.columns([0.7, 0.3])
+    with col1:
+        st.markdown(f"**{title}**")
+        st.markdown(description)
+    with col2:
+        st.markdown(get_trend_string(*indicator(values)), unsafe_allow_html=True)
+    st.markdown("---")
 
 # --- Main App Layout ---
 st.set_page_config(
@@ -98,91 +256,47 @@ st.title("Crypto Market Risk Dashboard 📊")
 
 # Data fetching and combining
 with st.spinner('Fetching market data... This may take a moment due to API call limits. Please be patient.'):
-    total_market_cap = fetch_aggregated_total_market_cap()
-    
-    if total_market_cap is None or total_market_cap.empty:
-        st.error("Could not retrieve enough market data to proceed. Please check your internet connection or CoinGecko API key.")
-        st.stop()
-    
-    individual_coin_market_caps = {}
-    for coin_id in TOP_10_COINS:
-        market_cap_series = fetch_coin_market_data(coin_id)
-        if market_cap_series is not None and not market_cap_series.empty:
-            individual_coin_market_caps[coin_id] = market_cap_series
-        time.sleep(0.5)
+    date_key = datetime.now(timezone.utc).date().isoformat()
+    _prune_stale_fetch_cache(date_key)
+    cols = build_indicators(date_key)
 
-    if not individual_coin_market_caps:
-        st.error("Could not fetch individual coin market data for calculations. The app cannot proceed.")
-        st.stop()
-
-    df = pd.DataFrame({'TOTAL': total_market_cap})
-    
-    for coin_id, series in individual_coin_market_caps.items():
-        df = df.merge(series.to_frame(), left_index=True, right_index=True, how='left')
-
-    df = df.dropna()
+# Failed coins aren't cached, but the indicators built without them are; drop those so the
+# next run retries just the missing coins while the rest are served from cache.
+missing_coins = TOP_10_COINS if cols is None else [coin for coin in TOP_10_COINS if coin not in cols]
+if missing_coins:
+    build_indicators.clear()
+    # Surface each distinct failure (per UTC day and set of missing coins) once per session
+    # instead of on every rerun
+    failure_key = (date_key, tuple(missing_coins))
+    if st.session_state.get('fetch_failure_notified') != failure_key:
+        st.toast(f"Could not fetch data for: {', '.join(missing_coins)}. Retrying on the next refresh.")
+        st.session_state['fetch_failure_notified'] = failure_key
+else:
+    st.session_state.pop('fetch_failure_notified', None)
 
-    missing_top_coins = [coin for coin in TOP_10_COINS if coin not in df.columns]
-    if missing_top_coins:
-        df['SUM_TOP_10'] = df[[col for col in TOP_10_COINS if col in df.columns]].sum(axis=1)
-    else:
-        df['SUM_TOP_10'] = df[TOP_10_COINS].sum(axis=1)
-
-# --- Perform Calculations and Present with Styling ---
-if not df.empty and 'bitcoin' in df.columns:
-    df['TOTAL2'] = df['TOTAL'] - df['bitcoin']
-    df['OTHERS'] = df['TOTAL'] - df['SUM_TOP_10']
-
-    # Calculate SMAs for all indicators
-    df['SMA_10_TOTAL'] = df['TOTAL'].rolling(window=10).mean()
-    df['SMA_30_TOTAL'] = df['TOTAL'].rolling(window=30).mean()
-    
-    df['TOTAL2_DIV_TOTAL'] = (df['TOTAL2'] / df['TOTAL']) * 100
-    df['SMA_10_T2T'] = df['TOTAL2_DIV_TOTAL'].rolling(window=10).mean()
-    df['SMA_30_T2T'] = df['TOTAL2_DIV_TOTAL'].rolling(window=30).mean()
-
-    df['OTHERS_DIV_TOTAL'] = (df['OTHERS'] / df['TOTAL']) * 100
-    df['SMA_10_OTHERS'] = df['OTHERS_DIV_TOTAL'].rolling(window=10).mean()
-    df['SMA_30_OTHERS'] = df['OTHERS_DIV_TOTAL'].rolling(window=30).mean()
-
-    # Determine trend and create a formatted string for display
-    def get_trend_string(sma10, sma30):
-        if sma10 > sma30:
-            return "🟢 **<span style='color:green'>Bullish</span>**"
-        else:
-            return "🔴 **<span style='color:red'>Bearish</span>**"
-
-    total_trend_str = get_trend_string(df['SMA_10_TOTAL'].iloc[-1], df['SMA_30_TOTAL'].iloc[-1])
-    t2t_trend_str = get_trend_string(df['SMA_10_T2T'].iloc[-1], df['SMA_30_T2T'].iloc[-1])
-    others_trend_str = get_trend_string(df['SMA_10_OTHERS'].iloc[-1], df['SMA_30_OTHERS'].iloc[-1])
+if cols is None:
+    st.error("Could not retrieve enough market data to proceed. Please check your internet connection or CoinGecko API key.")
+    st.stop()
 
+# --- Present Indicators with Styling ---
+if 'bitcoin' in cols:
     st.markdown("### Current Market Sentiment Indicators")
 
-    # Use st.columns for a clean, table-like layout
-    col1, col2 = st.columns([0.7, 0.3])
-    
-    with col1:
-        st.markdown("**Total Market Cap (TOTAL)**")
-        st.markdown("A bullish trend indicates the overall crypto market is in a positive uptrend.")
-    with col2:
-        st.markdown(total_trend_str, unsafe_allow_html=True)
-    st.markdown("---")
-
-    col1, col2 = st.columns([0.7, 0.3])
-    with col1:
-        st.markdown("**Altcoins vs. BTC (TOTAL2 / TOTAL)**")
-        st.markdown("A bullish trend indicates altcoins are outperforming Bitcoin, suggesting a 'risk-on' rotation.")
-    with col2:
-        st.markdown(t2t_trend_str, unsafe_allow_html=True)
-    st.markdown("---")
-    
-    col1, col2 = st.columns([0.7, 0.3])
-    with col1:
-        st.markdown("**High-Risk Alts (OTHERS / TOTAL)**")
-        st.markdown("A bullish trend indicates smaller, more speculative altcoins are outperforming, signaling high-risk appetite.")
-    with col2:
-        st.markdown(others_trend_str, unsafe_allow_html=True)
-    st.markdown("---")
+    indicator_panel(
+        "Total Market Cap (TOTAL)",
+        "A bullish trend indicates the overall crypto market is in a positive uptrend.",
+        cols['TOTAL']
+    )
+    indicator_panel(
+        "Altcoins vs. BTC (TOTAL2 / TOTAL)",
+        "A bullish trend indicates altcoins are outperforming Bitcoin, suggesting a 'risk-on' rotation.",
+        cols['TOTAL2_DIV_TOTAL']
+    )
+    indicator_panel(
+        "High-Risk Alts (OTHERS / TOTAL)",
+        "A bullish trend indicates smaller, more speculative altcoins are outperforming, signaling high-risk appetite.",
+        cols['OTHERS_DIV_TOTAL']
+    )
 
 else:
     st.error("Failed to generate indicators due to insufficient data or missing 'bitcoin' column.")